@@ -115,7 +115,7 @@ class AFCtrigger:
 
         if self.led_index is not None:
             # Verify that LED config is found
-            error_string, led = self.AFC.FUNCTION.verify_led_object(self.led_index)
+            error_string, led, _ = self.AFC.FUNCTION.verify_led_object(self.led_index)
             if led is None:
                 raise error(error_string)
 
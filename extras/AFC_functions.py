@@ -4,10 +4,13 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
+import io
 import os
 import re
+import time
+import shutil
+import functools
 from configfile import error
-from datetime import datetime
 try:
     from extras.AFC_respond import AFCprompt
 except:
@@ -16,6 +19,18 @@ except:
 def load_config(config):
     return afcFunction(config)
 
+@functools.lru_cache(maxsize=128)
+def _hex_convert(tmp):
+    """
+    Converts an led color string into a hex color, results are cached since only a small set of colors are used
+
+    :param tmp: Comma separated color string with values between 0 and 1 (eg. 1,0,0.5,0)
+
+    :return string: Color in #rrggbb format
+    """
+    rgb = tuple(max(0, min(255, int(255 * float(p)))) for p in tmp.split(',')[:3])
+    return '#{:02x}{:02x}{:02x}'.format(*rgb)
+
 class afcFunction:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -24,6 +39,10 @@ class afcFunction:
         self.printer.register_event_handler("afc_hub:register_macros",self.register_hub_macros)
         self.errorLog = {}
         self.pause    = False
+        self._print_stats  = None   # Looked up on first use by printer state helpers
+        self._pause_resume = None
+        self._led_cache = {}    # Resolved AFC_led objects keyed by led_index string
+        self._tcmd_used = 0     # Bitmap of T command indexes known to be assigned, bit n set means Tn is taken
 
     def register_lane_macros(self, lane_obj):
         """
@@ -61,42 +80,77 @@ class afcFunction:
         self.AFC.gcode.register_command('AFC_RESET'      , self.cmd_AFC_RESET      , desc=self.cmd_AFC_RESET_help)
         self.AFC.gcode.register_command('AFC_LANE_RESET' , self.cmd_LANE_RESET     , desc=self.cmd_LANE_RESET_help)
 
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _section_re(name):
+        """
+        Helper function to build and cache regex pattern used to find a section header in config files
+
+        :param name: Name of section to match, special characters are escaped
+
+        :return re.Pattern: Compiled pattern matching `[name]` at the start of a line
+        """
+        return re.compile(r"^\[\s*" + re.escape(name) + r"\s*\]")
+
     def ConfigRewrite(self, rawsection, rawkey, rawvalue, msg=""):
         taskdone = False
         sectionfound = False
         # Creating regex pattern based off rawsection
-        pattern = re.compile("^\[\s*{}\s*\]".format(rawsection))
-        for filename in os.listdir(self.AFC.cfgloc):
-            file_path = os.path.join(self.AFC.cfgloc, filename)
-            if os.path.isfile(file_path) and filename.endswith(".cfg"):
+        pattern = self._section_re(rawsection)
+        with os.scandir(self.AFC.cfgloc) as entries:
+            for entry in entries:
+                # Check suffix first so is_file is only called for .cfg entries
+                if not (entry.name.endswith(".cfg") and entry.is_file()): continue
+                file_path = entry.path
                 with open(file_path, 'r') as f:
-                    dataout = ''
-                    for line in f:
-                        # If previous section found and line starts with bracket, means that this line is another section
-                        #  need to put sectionfound to false to not update wrong sections if rawkey is not found
-                        if sectionfound and line.startswith("["): sectionfound = False
-
-                        if re.match(pattern, line) is not None: sectionfound = True
-                        if sectionfound == True and line.startswith(rawkey):
-                            comments = ""
-                            comment_index = 0
-                            try:
-                                comment_index = line.index('#')
-                                comments = line[comment_index:-1]
-                            except ValueError:
-                                pass
-                            line = "{}: {}".format(rawkey, rawvalue )
-                            # Left justifying comment with spaces so its in original position
-                            line = line.ljust(comment_index - 1, " ")
-
-                            line = "{} {}\n".format(line, comments)
-                            sectionfound = False
-                            taskdone = True
-                        dataout += line
+                    text = f.read()
+
+                # Skip parsing files that cannot contain the section
+                if rawsection not in text: continue
+
+                out = []
+                # StringIO only splits on newlines, same as iterating over the file object
+                for line in io.StringIO(text):
+                    # If previous section found and line starts with bracket, means that this line is another section
+                    #  need to put sectionfound to false to not update wrong sections if rawkey is not found
+                    if sectionfound and line.startswith("["): sectionfound = False
+
+                    if pattern.match(line) is not None: sectionfound = True
+                    if sectionfound == True and line.startswith(rawkey):
+                        comments = ""
+                        comment_index = 0
+                        try:
+                            comment_index = line.index('#')
+                            comments = line[comment_index:-1]
+                        except ValueError:
+                            pass
+                        line = "{}: {}".format(rawkey, rawvalue )
+                        # Left justifying comment with spaces so its in original position
+                        line = line.ljust(comment_index - 1, " ")
+
+                        line = "{} {}\n".format(line, comments)
+                        sectionfound = False
+                        taskdone = True
+                    out.append(line)
+                dataout = ''.join(out)
+
                 if taskdone:
-                    f=open(file_path, 'w')
-                    f.write(dataout)
-                    f.close
+                    # Write to a temporary file and swap it in so a crash mid write cannot corrupt config file,
+                    #  resolving links so a symlinked config file is updated instead of replaced
+                    real_path = os.path.realpath(file_path)
+                    tmp_path = real_path + ".tmp"
+                    try:
+                        with open(tmp_path, 'w') as f:
+                            f.write(dataout)
+                            # Make sure data is on disk before swapping files
+                            f.flush()
+                            os.fsync(f.fileno())
+                        shutil.copymode(real_path, tmp_path)
+                        os.replace(tmp_path, real_path)
+                    finally:
+                        # Only exists here if writing or replacing failed
+                        if os.path.exists(tmp_path):
+                            os.remove(tmp_path)
                     taskdone = False
                     msg +='\n<span class=info--text>Saved {}:{} in {} section to configuration file</span>'.format(rawkey, rawvalue, rawsection)
                     self.logger.info(msg)
@@ -106,11 +160,21 @@ class afcFunction:
 
     def TcmdAssign(self, CUR_LANE):
         if CUR_LANE.map == 'NONE' :
-            for x in range(99):
+            while True:
+                # Isolate lowest clear bit in bitmap to find lowest T command index not yet handed out
+                x = (~self._tcmd_used & (self._tcmd_used + 1)).bit_length() - 1
+                if x >= 99: break
+                self._tcmd_used |= 1 << x
                 cmd = 'T'+str(x)
+                # Commands restored from vars file or set with SET_MAP are only in tool_cmds
                 if cmd not in self.AFC.tool_cmds:
                     CUR_LANE.map = cmd
                     break
+        elif CUR_LANE.map.startswith('T') and CUR_LANE.map[1:].isdecimal():
+            # Bitmap only tracks T0-T98 that can be handed out automatically
+            x = int(CUR_LANE.map[1:])
+            if x < 99:
+                self._tcmd_used |= 1 << x
         self.AFC.tool_cmds[CUR_LANE.map]=CUR_LANE.name
         try:
             self.AFC.gcode.register_command(CUR_LANE.map, self.AFC.cmd_CHANGE_TOOL, desc=self.AFC.cmd_CHANGE_TOOL_help)
@@ -118,6 +182,26 @@ class afcFunction:
             self.logger.info("Error trying to map lane {lane} to {tool_macro}, please make sure there are no macros already setup for {tool_macro}".format(lane=[CUR_LANE.name], tool_macro=CUR_LANE.map), )
         self.AFC.save_vars()
 
+    def _get_print_stats(self):
+        """
+        Helper function to lookup print_stats object once and reuse it for later calls
+
+        :return object: print_stats object, klipper errors out if it is not configured
+        """
+        if self._print_stats is None:
+            self._print_stats = self.printer.lookup_object("print_stats")
+        return self._print_stats
+
+    def _get_pause_resume(self):
+        """
+        Helper function to lookup pause_resume object once and reuse it for later calls
+
+        :return object: pause_resume object, klipper errors out if it is not configured
+        """
+        if self._pause_resume is None:
+            self._pause_resume = self.printer.lookup_object("pause_resume")
+        return self._pause_resume
+
     def is_homed(self):
         """
         Helper function to determine if printer is currently homed
@@ -138,8 +222,7 @@ class afcFunction:
         :return boolean: True if anything in the printer is moving
         '''
         eventtime = self.AFC.reactor.monotonic()
-        idle_timeout = self.printer.lookup_object("idle_timeout")
-        return idle_timeout.get_status(eventtime)["state"] == "Printing"
+        return self.AFC.IDLE.get_status(eventtime)["state"] == "Printing"
 
     def in_print(self):
         """
@@ -149,8 +232,7 @@ class afcFunction:
         """
         print_stats_idle_states = ['standby', 'error']
         eventtime = self.AFC.reactor.monotonic()
-        print_stats = self.printer.lookup_object("print_stats")
-        print_state = print_stats.get_status(eventtime)["state"]
+        print_state = self._get_print_stats().get_status(eventtime)["state"]
         return print_state not in print_stats_idle_states
 
     def is_printing(self, check_movement=False):
@@ -162,13 +244,12 @@ class afcFunction:
         :return boolean: True if printer is printing an object or if printer is moving when `check_movement` is True
         '''
         eventtime = self.AFC.reactor.monotonic()
-        print_stats = self.printer.lookup_object("print_stats")
         moving = False
 
         if check_movement:
             moving = self.is_moving()
 
-        return print_stats.get_status(eventtime)["state"] == "printing" or moving
+        return self._get_print_stats().get_status(eventtime)["state"] == "printing" or moving
 
     def is_paused(self):
         """
@@ -177,8 +258,7 @@ class afcFunction:
         :return boolean: True when printer is paused
         """
         eventtime = self.AFC.reactor.monotonic()
-        pause_resume = self.printer.lookup_object("pause_resume")
-        return bool(pause_resume.get_status(eventtime)["is_paused"])
+        return bool(self._get_pause_resume().get_status(eventtime)["is_paused"])
 
     def get_current_lane(self):
         """
@@ -187,9 +267,9 @@ class afcFunction:
         :return string: Current lane name that is loaded, None if nothing is loaded
         """
         if self.printer.state_message == 'Printer is ready':
-            current_extruder = self.AFC.toolhead.get_extruder().name
-            if current_extruder in self.AFC.tools:
-                return self.AFC.tools[current_extruder].lane_loaded
+            tool = self.AFC.tools.get(self.AFC.toolhead.get_extruder().name)
+            if tool is not None:
+                return tool.lane_loaded
         return None
 
     def get_current_lane_obj(self):
@@ -198,36 +278,41 @@ class afcFunction:
 
         :return object: None if nothing is loaded, AFC_stepper object if a lane is currently loaded
         """
-        curr_lane_obj = None
-        curr_lane = self.get_current_lane()
-        if curr_lane in self.AFC.lanes:
-            curr_lane_obj = self.AFC.lanes[curr_lane]
-        return curr_lane_obj
+        return self.AFC.lanes.get(self.get_current_lane())
 
     def verify_led_object(self, led_name):
         """
-        Helper function to lookup AFC_led object.
+        Helper function to lookup AFC_led object and parse led index. Results are cached by led_name.
 
-        :params led_name: name of AFC_led object to lookup
+        :params led_name: name of AFC_led object and led index to lookup in `<AFC_led name>:<index>` format
 
-        :return (string, object): error_string if AFC_led object is not found, led object if found
+        :return (string, object, int): error_string if AFC_led object is not found or index is invalid, led object
+                                       and led index if found
         """
-        error_string = ""
-        led = None
-        afc_object = 'AFC_led '+ led_name.split(':')[0]
+        cached = self._led_cache.get(led_name)
+        if cached is not None:
+            return "", cached[0], cached[1]
+
+        name, _, index = led_name.partition(':')
+        afc_object = 'AFC_led '+ name
         try:
             led = self.printer.lookup_object(afc_object)
         except:
-            error_string = "Error: Cannot find [{}] in config, make sure led_index in config is correct for AFC_stepper {}".format(afc_object, led_name.split(':')[-1])
-        return error_string, led
+            return "Error: Cannot find [{}] in config, make sure led_index in config is correct for AFC_stepper {}".format(afc_object, index or name), None, None
+        try:
+            index = int(index)
+        except ValueError:
+            return "Error: Invalid led index '{}' for [{}], make sure led_index in config is correct".format(led_name, afc_object), None, None
+        self._led_cache[led_name] = (led, index)
+        return "", led, index
 
     def afc_led (self, status, idx=None):
         if idx == None:
             return
 
-        error_string, led = self.verify_led_object(idx)
+        error_string, led, index = self.verify_led_object(idx)
         if led is not None:
-            led.led_change(int(idx.split(':')[1]), status)
+            led.led_change(index, status)
         else:
             self.logger.info( error_string )
 
@@ -235,10 +320,10 @@ class afcFunction:
         if CUR_LANE.prep_state:
             if CUR_LANE.load_state:
                 if CUR_LANE.extruder_obj is not None and CUR_LANE.extruder_obj.lane_loaded == CUR_LANE.name:
-                    return 'In Tool:' + self.HexConvert(CUR_LANE.led_tool_loaded).split(':')[-1]
-                return "Ready:" + self.HexConvert(CUR_LANE.led_ready).split(':')[-1]
-            return 'Prep:' + self.HexConvert(CUR_LANE.led_prep_loaded).split(':')[-1]
-        return 'Not Ready:' + self.HexConvert(CUR_LANE.led_not_ready).split(':')[-1]
+                    return 'In Tool:' + CUR_LANE.led_hex["tool_loaded"]
+                return "Ready:" + CUR_LANE.led_hex["ready"]
+            return 'Prep:' + CUR_LANE.led_hex["prep_loaded"]
+        return 'Not Ready:' + CUR_LANE.led_hex["not_ready"]
 
     def handle_activate_extruder(self):
         """
@@ -246,8 +331,14 @@ class afcFunction:
 
         This will also be tied to a callback once multiple extruders are implemented
         """
-        cur_lane_loaded = self.get_current_lane_obj()
+        self._activate_lane(self.get_current_lane_obj())
 
+    def _activate_lane(self, cur_lane_loaded):
+        """
+        Deactivates lanes motors and buffers for all lanes except cur_lane_loaded, then enables cur_lane_loaded
+
+        :param cur_lane_loaded: Lane object loaded into the active toolhead, None if nothing is loaded
+        """
         # Disable extruder steppers for non active lanes
         for key, obj in self.AFC.lanes.items():
             if cur_lane_loaded is None or key != cur_lane_loaded.name:
@@ -277,35 +368,20 @@ class afcFunction:
         if cur_lane_loaded is not None:
             cur_lane_loaded.unsync_to_extruder()
             cur_lane_loaded.set_unloaded()
-            self.AFC.FUNCTION.handle_activate_extruder()
+            # Lane was just unloaded from active toolhead, no need to look up current lane again
+            self._activate_lane(None)
             self.logger.info("Manually removing {} loaded from toolhead".format(cur_lane_loaded.name))
             self.AFC.save_vars()
 
     def log_toolhead_pos(self, move_pre=""):
-        msg = "{}Position: {}".format(move_pre, self.AFC.toolhead.get_position())
-        msg += " base_position: {}".format(self.AFC.gcode_move.base_position)
-        msg += " last_position: {}".format(self.AFC.gcode_move.last_position)
-        msg += " homing_position: {}".format(self.AFC.gcode_move.homing_position)
-        msg += " speed: {}".format(self.AFC.gcode_move.speed)
-        msg += " absolute_coord: {}\n".format(self.AFC.gcode_move.absolute_coord)
+        gm = self.AFC.gcode_move
+        th = self.AFC.toolhead
+        msg = "{}Position: {} base_position: {} last_position: {} homing_position: {} speed: {} absolute_coord: {}\n".format(
+            move_pre, th.get_position(), gm.base_position, gm.last_position, gm.homing_position, gm.speed, gm.absolute_coord)
         self.logger.debug(msg, only_debug=True)
 
     def HexConvert(self,tmp):
-        led=tmp.split(',')
-        if float(led[0])>0:
-            led[0]=int(255*float(led[0]))
-        else:
-            led[0]=0
-        if float(led[1])>0:
-            led[1]=int(255*float(led[1]))
-        else:
-            led[1]=0
-        if float(led[2])>0:
-            led[2]=int(255*float(led[2]))
-        else:
-            led[2]=0
-
-        return '#{:02x}{:02x}{:02x}'.format(*led)
+        return _hex_convert(tmp)
 
     cmd_AFC_CALIBRATION_help = 'open prompt to begin calibration by selecting Unit to calibrate'
     def cmd_AFC_CALIBRATION(self, gcmd):
@@ -420,53 +496,29 @@ class afcFunction:
         # Determine if a specific lane is provided
         if lanes is not None:
             self.logger.info('Starting AFC distance Calibrations')
-            if unit is None:
-                if lanes != 'all':
-                    CUR_LANE = self.AFC.lanes[lanes]
-                    checked, msg, pos = CUR_LANE.unit_obj.calibrate_lane(CUR_LANE, tol)
-                    if(not checked):
-                        self.AFC.ERROR.AFC_error(msg, False)
-                        if pos > 0:
-                            self.AFC.gcode.run_script_from_command('AFC_CALI_FAIL FAIL={} DISTANCE={}'.format(CUR_LANE, pos))
-                        return
-                    else: calibrated.append(lanes)
-                else:
-                    # Calibrate all lanes if no specific lane is provided
-                    for CUR_LANE in self.AFC.lanes.values():
-                        if not CUR_LANE.load_state or not CUR_LANE.prep_state:
-                            self.logger.info("{} not loaded skipping to next loaded lane".format(CUR_LANE.name))
-                            continue
-                        # Calibrate the specific lane
-                        checked, msg, pos = CUR_LANE.unit_obj.calibrate_lane(CUR_LANE, tol)
-                        if(not checked):
-                            self.AFC.ERROR.AFC_error(msg, False)
-                            self.AFC.gcode.run_script_from_command('AFC_CALI_FAIL FAIL={} DISTANCE={}'.format(CUR_LANE, pos))
-                            return
-                        else: calibrated.append(CUR_LANE.name)
+            if lanes != 'all':
+                lanes_to_cal = [self.AFC.lanes[lanes]]
+            elif unit is not None:
+                CUR_UNIT = self.AFC.units[unit]
+                self.logger.info('{}'.format(CUR_UNIT.name))
+                lanes_to_cal = CUR_UNIT.lanes.values()
             else:
-                if lanes != 'all':
-                    CUR_LANE = self.AFC.lanes[lanes]
-                    checked, msg, pos = CUR_LANE.unit_obj.calibrate_lane(CUR_LANE, tol)
-                    if(not checked):
-                        self.AFC.ERROR.AFC_error(msg, False)
+                lanes_to_cal = self.AFC.lanes.values()
+
+            for CUR_LANE in lanes_to_cal:
+                # Only skip unloaded lanes when calibrating all lanes, a specific lane reports why it cannot calibrate
+                if lanes == 'all' and (not CUR_LANE.load_state or not CUR_LANE.prep_state):
+                    self.logger.info("{} not loaded skipping to next loaded lane".format(CUR_LANE.name))
+                    continue
+                # Calibrate the specific lane
+                checked, msg, pos = CUR_LANE.unit_obj.calibrate_lane(CUR_LANE, tol)
+                if(not checked):
+                    self.AFC.ERROR.AFC_error(msg, False)
+                    # pos is 0 when a precondition failed before the lane moved, nothing to reset in that case
+                    if pos > 0:
                         self.AFC.gcode.run_script_from_command('AFC_CALI_FAIL FAIL={} DISTANCE={}'.format(CUR_LANE, pos))
-                        return
-                    else: calibrated.append(lanes)
-                else:
-                    CUR_UNIT = self.AFC.units[unit]
-                    self.logger.info('{}'.format(CUR_UNIT.name))
-                    # Calibrate all lanes if no specific lane is provided
-                    for CUR_LANE in CUR_UNIT.lanes.values():
-                        if not CUR_LANE.load_state or  not CUR_LANE.prep_state:
-                            self.logger.info("{} not loaded skipping to next loaded lane".format(CUR_LANE.name))
-                            continue
-                        # Calibrate the specific lane
-                        checked, msg, pos = CUR_UNIT.calibrate_lane(CUR_LANE, tol)
-                        if(not checked):
-                            self.AFC.ERROR.AFC_error(msg, False)
-                            self.AFC.gcode.run_script_from_command('AFC_CALI_FAIL FAIL={} DISTANCE={}'.format(CUR_LANE, pos))
-                            return
-                        else: calibrated.append(CUR_LANE.name)
+                    return
+                else: calibrated.append(CUR_LANE.name)
 
             self.logger.info("Lane calibration Done!")
 
@@ -779,18 +831,20 @@ class afcFunction:
             None
         """
         hub           = gcmd.get("HUB", None )
-        length_param  = gcmd.get('LENGTH', None)
-        unload_length = gcmd.get('UNLOAD_LENGTH', None)
+        # Treat empty values the same as values not passed in
+        length_param  = (gcmd.get('LENGTH', None) or '').strip() or None
+        unload_length = (gcmd.get('UNLOAD_LENGTH', None) or '').strip() or None
 
         # If hub is not passed in try and get hub if a lane is currently loaded
-        if hub is None and self.AFC.current is not None:
-            CUR_LANE = self.AFC.lanes[self.current]
-            hub     = CUR_LANE.hub_obj.name
-        elif hub is None and self.current is None:
+        if hub is not None:
+            CUR_HUB = self.AFC.hubs[hub]
+        elif self.AFC.current is not None:
+            CUR_HUB = self.AFC.lanes[self.AFC.current].hub_obj
+            hub     = CUR_HUB.name
+        else:
             self.logger.info("A lane is not loaded please specify hub to adjust bowden length")
             return
 
-        CUR_HUB                 = self.AFC.hubs[hub]
         cur_bowden_len          = CUR_HUB.afc_bowden_length
         cur_unload_bowden_len   = CUR_HUB.afc_unload_bowden_length
 
@@ -892,12 +946,12 @@ class afcDeltaTime:
         self.last_time  = None
 
     def set_start_time(self):
-        self.major_delta_time = self.last_time = self.start_time = datetime.now()
+        self.major_delta_time = self.last_time = self.start_time = time.monotonic()
 
     def log_with_time(self, msg, debug=True):
-        curr_time = datetime.now()
-        delta_time = (curr_time - self.last_time ).total_seconds()
-        total_time = (curr_time - self.start_time).total_seconds()
+        curr_time = time.monotonic()
+        delta_time = curr_time - self.last_time
+        total_time = curr_time - self.start_time
         msg = "{} (Δt:{:.3f}s, t:{:.3f})".format( msg, delta_time, total_time )
         if debug:
             self.logger.debug( msg )
@@ -906,14 +960,14 @@ class afcDeltaTime:
         self.last_time = curr_time
 
     def log_major_delta(self, msg, debug=True):
-        curr_time = datetime.now()
-        delta_time = (curr_time - self.major_delta_time ).total_seconds()
+        curr_time = time.monotonic()
+        delta_time = curr_time - self.major_delta_time
         msg = "{} t:{:.3f}".format( msg, delta_time )
         self.logger.info( msg )
         self.major_delta_time = curr_time
 
     def log_total_time(self, msg):
-        total_time = (datetime.now() - self.start_time).total_seconds()
+        total_time = time.monotonic() - self.start_time
         msg = "{} t:{:.3f}".format( msg, total_time )
 
         self.logger.info( msg )
@@ -201,7 +201,7 @@ class AFCExtruderStepper:
 
         if self.led_index is not None:
             # Verify that LED config is found
-            error_string, led = self.AFC.FUNCTION.verify_led_object(self.led_index)
+            error_string, led, _ = self.AFC.FUNCTION.verify_led_object(self.led_index)
             if led is None:
                 raise error(error_string)
 
@@ -299,6 +299,14 @@ class AFCExtruderStepper:
         if self.led_unloading is None: self.led_unloading = self.unit_obj.led_unloading
         if self.led_tool_loaded is None: self.led_tool_loaded = self.unit_obj.led_tool_loaded
 
+        # LED colors do not change at runtime, convert colors reported in status to hex once
+        self.led_hex = {
+            "tool_loaded":  self.AFC.FUNCTION.HexConvert(self.led_tool_loaded),
+            "ready":        self.AFC.FUNCTION.HexConvert(self.led_ready),
+            "prep_loaded":  self.AFC.FUNCTION.HexConvert(self.led_prep_loaded),
+            "not_ready":    self.AFC.FUNCTION.HexConvert(self.led_not_ready),
+        }
+
         if self.long_moves_speed is None: self.long_moves_speed = self.unit_obj.long_moves_speed
         if self.long_moves_accel is None: self.long_moves_accel = self.unit_obj.long_moves_accel
         if self.short_moves_speed is None: self.short_moves_speed = self.unit_obj.short_moves_speed